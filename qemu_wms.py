@@ -29,21 +29,26 @@ normally a problem but be aware that:
 
 Martin Bond: June 2022
 """
+import asyncio
 import socket
 import threading
+import time
 import zipfile
-from collections import namedtuple
+from collections import deque, namedtuple
 import tkinter as tk
-from datetime import datetime
 from enum import Enum
-from queue import Queue
 from tkinter import ttk, messagebox
 from typing import AnyStr, Optional
 
 __VERSION__ = '0.9.0'
 
 POLL = 100
+ANIMATE = 100
 DISPLAY_WARN = 5000
+DRAIN_LIMIT = 64
+RECV_SIZE = 4096
+SOCKET_BUFFER = 65536
+SEND_RING = 64
 
 
 class ButtonStyle(Enum):
@@ -70,6 +75,7 @@ class Config:
     board_image = 'feabhas-wms-768.png'
     image_x = 768
     image_y = 356
+    grid_shift = 5          # button hit test grid cells are 32x32 pixels
 
     buttons = [
         Button('reset', None, ButtonStyle.plain, '', 'reset ', 32, 200, 8),
@@ -81,6 +87,7 @@ class Config:
         Button('accept', 5, ButtonStyle.latch, 'D0L5 ', 'D0d5 ', 575, 130, 12),
         Button('motor', 6, ButtonStyle.plain, 'D0L6 ', 'D0d6 ', 650, 230, 50),
     ]
+    latch_buttons = [button for button in buttons if button.style == ButtonStyle.latch]
 
     overlays = {
         "led": Overlay(207, 298, ['led-0.png', 'led-1.png']),
@@ -115,127 +122,272 @@ class QEmuTag(Enum):
     sr = 22
 
 
+def invalid_reply(reply: bytes):
+    return QEmuTag.warning, f'Invalid command response: {reply.decode("ascii", "replace")}'
+
+
+def pin_low_reply(reply: bytes):
+    return QEmuTag.pin_low, int(reply[2:3], 16)
+
+
+def pin_high_reply(reply: bytes):
+    return QEmuTag.pin_high, int(reply[2:3], 16)
+
+
+def value_reply(reply: bytes):
+    """ Decodes `=<source>.../<hex>` replies for memory and register queries """
+    slash = reply.rfind(b'/')
+    value = int(reply[slash+1:], 16)
+    if reply[1] == ord('m'):
+        tag = ADDRESS_TAGS.get(reply[slash-5:slash-1])
+        if tag is None:
+            return QEmuTag.warning, f'Invalid memory address: {reply.decode("ascii", "replace")}'
+    else:
+        tag = REGISTER_TAGS.get(reply[1:3])
+        if tag is None:
+            return QEmuTag.warning, f'Invalid response format: {reply.decode("ascii", "replace")}'
+    return tag, value
+
+
+def parse_replies(replies: list, out: list):
+    """ Identifies each reply token and appends a (tag, value) tuple to `out` """
+    handler_for = REPLY_HANDLERS.get
+    append = out.append
+    for reply in replies:
+        handler = handler_for(reply[0])
+        if handler:
+            try:
+                append(handler(reply))
+            except (IndexError, ValueError):
+                append((QEmuTag.warning, f'Invalid response format: {reply.decode("ascii", "replace")}'))
+
+
+# Lookup tables built once to identify reply tokens without a startswith chain
+ADDRESS_TAGS = {
+    b'3830': QEmuTag.gpiod_enabled,
+    # b'3840': QEmuTag.usart3_enabled,
+}
+
+REGISTER_TAGS = {
+    b'd0': QEmuTag.moder,
+    b'd4': QEmuTag.idr,
+    b'u0': QEmuTag.sr,
+}
+
+REPLY_HANDLERS = {
+    ord('?'): invalid_reply,
+    ord('-'): pin_low_reply,
+    ord('+'): pin_high_reply,
+    ord('='): value_reply,
+}
+
+
 class QEmuListener:
-    """ Socket listening class connect to localhost:8888"""
-    def __init__(self, host='localhost', port=8889):
+    """
+    Socket listening class connect to localhost:8888
+    The socket is connected synchronously (so connection errors
+    are reported to the caller) and then driven by asyncio
+    streams on the Diagnostics event loop after `open()`
+    """
+    def __init__(self, host='localhost', port=8889, timeout=5):
+        self.closed = False
+        self.reader = None
+        self.writer = None
+        self.buffer = bytearray()
         try:
-            self.socket = socket.create_connection((host, port), timeout=5)
+            self.socket = socket.create_connection((host, port), timeout=timeout)
         except (ConnectionRefusedError, BrokenPipeError) as err:
             raise WmsError(f'Cannot connect to QEMU WMS: {err}')
+        # small latency sensitive commands: disable Nagle and allow for reply bursts
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(sock=self.socket)
 
     def close(self):
-        self.socket.close()
+        """
+        Note: must be called on the event loop once opened,
+        shutting down the socket wakes a pending read with
+        end of file so `chunks()` finishes cleanly
+        """
+        self.closed = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass    # already disconnected
+        if self.writer:
+            self.writer.close()
+        else:
+            self.socket.close()
 
-    def read(self, wait=True) -> str:
-        retry = 3
+    async def chunks(self):
+        """ Yields the list of whitespace terminated replies (as bytes) from each read """
         while True:
-            try:
-                data = self.socket.recv(128)
-                while data and data[0] == 0xff:
-                    data = data[3:]
-                if data or not wait:
-                    # if data[0] in b'+-': print('r', data)
-                    break
-            except socket.timeout:
-                retry += 1
-                if retry > 3:
-                    raise UserWarning('Warning: QEMU connection receiver timeout')
-
-        return data.strip().decode('ascii')
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                if self.closed:
+                    return
+                raise ConnectionResetError('QEMU connection closed')
+            self.buffer.extend(data)
+            replies = self.extract()
+            if replies:
+                yield replies
+
+    def extract(self) -> list:
+        """
+        Strips telnet (IAC) commands from the buffer in place and
+        removes all complete tokens, any partial token or telnet
+        command is retained until more data arrives
+        """
+        buffer = self.buffer
+        iac = buffer.find(0xff)
+        while 0 <= iac <= len(buffer) - 3:
+            del buffer[iac:iac+3]
+            iac = buffer.find(0xff, iac)
+        end = len(buffer) if iac < 0 else iac
+        while end and not buffer[end-1:end].isspace():
+            end -= 1
+        if not end:
+            return []
+        replies = bytes(buffer[:end]).split()
+        del buffer[:end]
+        return replies
 
     def write(self, message: AnyStr):
-        """ Note: assumes each message is whitespace terminated """
+        """
+        Note: assumes each message is whitespace terminated,
+        must be called on the event loop (the transport buffers
+        any data that cannot be sent immediately)
+        """
         if isinstance(message, str):
             message = message.encode('ascii')
         # print('w ', message)
-        total = 0
-        while total < len(message):
-            sent = self.socket.send(message[total:])
-            if sent == 0:
-                raise UserWarning(f'Warning: QEMU connection send error {message}')
-            total += sent
+        if self.writer.is_closing():
+            raise UserWarning(f'Warning: QEMU connection send error {message}')
+        self.writer.write(message)
+
+
+class SpscRing:
+    """
+    Fixed capacity single producer single consumer ring buffer
+    Only the producer moves `head` and only the consumer moves
+    `tail` so no lock is needed (the GIL makes each store atomic).
+    One slot is always left empty to tell a full ring from an
+    empty one.
+    """
+    def __init__(self, capacity: int):
+        if capacity < 2 or capacity & (capacity - 1):
+            raise ValueError(f'Ring capacity must be a power of two: {capacity}')
+        self.mask = capacity - 1
+        self.buffer = [None] * capacity
+        self.head = 0
+        self.tail = 0
+
+    def push(self, item) -> bool:
+        """ Producer only: returns False (item dropped) if the ring is full """
+        head = self.head
+        after = (head + 1) & self.mask
+        if after == self.tail:
+            return False
+        self.buffer[head] = item
+        self.head = after
+        return True
+
+    def pop_many(self, limit: int) -> list:
+        """ Consumer only: removes up to `limit` items """
+        items = []
+        buffer, mask = self.buffer, self.mask
+        tail, head = self.tail, self.head
+        while tail != head and len(items) < limit:
+            items.append(buffer[tail])
+            buffer[tail] = None
+            tail = (tail + 1) & mask
+        self.tail = tail
+        return items
 
 
 class Diagnostics:
     """
     Asynchronous send/recv wrapped around QEmuListener
-    Uses Queue objects to
-       * pass through commands from front end
-       * read async reposes from back end and identify type
-         to write a tuple (type, value) back to front end
+    A single background thread hosts an asyncio event loop which
+    drives the socket, using
+       * an SpscRing to pass through commands from front end, all
+         commands pending when the loop gets to them are written
+         as a single message
+       * an (unbounded) deque to return async responses from back
+         end identified as a tuple (type, value) to the front end,
+         pin changes are only reported once so none may be lost
+    Front end calls never block: a flush of pending commands is
+    scheduled with `call_soon_threadsafe` and responses are polled.
     """
     def __init__(self):
-        self.send = Queue()
-        self.recv = Queue()
+        self.send = SpscRing(SEND_RING)
+        self.flushing = False
+        self.recv = deque()
         self.qemu = QEmuListener()
-        listener = threading.Thread(target=self.listen)
-        listener.setDaemon(True)
-        listener.start()
-        runner = threading.Thread(target=self.run)
-        runner.setDaemon(True)
-        runner.start()
-        self.command('noecho ')
-        self.command('listen ')
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.qemu.open(), self.loop).result()
+        asyncio.run_coroutine_threadsafe(self.listen(), self.loop)
+        self.command('noecho listen ')
 
     def close(self):
-        self.qemu.close()
+        self.loop.call_soon_threadsafe(self.qemu.close)
 
     def command(self, command):
-        self.send.put((QEmuTag.command, command))
+        self.write(QEmuTag.command, command)
 
     def write(self, tag: QEmuTag, value):
-        self.send.put((tag, value))
-
-    def read(self):
-        if self.recv.empty():
-            return None, None
-        return self.recv.get()
-
-    def run(self):
-        while True:
-            try:
-                tag, value = self.send.get()
-                self.qemu.write(value)
-            except UserWarning as ex:
-                self.recv.put((QEmuTag.warning, str(ex)))
-            except OSError:
-                break  # raise UserWarning('Warning: QEMU connection closed')
+        if self.qemu.closed:
+            return
+        if isinstance(value, str):
+            value = value.encode('ascii')
+        if not self.send.push(value):
+            raise UserWarning(f'Warning: QEMU command dropped (send queue full) {value}')
+        if not self.flushing:
+            self.flushing = True
+            self.loop.call_soon_threadsafe(self.flush)
+
+    def drain(self, limit=DRAIN_LIMIT):
+        """ Removes up to `limit` queued responses """
+        items = []
+        try:
+            for _ in range(limit):
+                items.append(self.recv.popleft())
+        except IndexError:
+            pass
+        return items
+
+    def flush(self):
+        """ Note: runs on the event loop """
+        self.flushing = False       # cleared first so later writes schedule another flush
+        message = b''.join(self.send.pop_many(SEND_RING))
+        if not message:
+            return
+        try:
+            self.qemu.write(message)
+        except UserWarning as ex:
+            self.recv.append((QEmuTag.warning, str(ex)))
+        except OSError:
+            pass  # raise UserWarning('Warning: QEMU connection closed')
 
-    def listen(self):
+    async def listen(self):
         """ Note: assumes all responses are whitespace (newline etc) terminated"""
-        while True:
-            try:
-                replies = self.qemu.read().split()
-                for reply in replies:
-                    if reply.startswith('?'):
-                        self.recv.put((QEmuTag.warning, f'Invalid command response: {reply}'))
-                    elif reply.startswith('-'):
-                        self.recv.put((QEmuTag.pin_low, int(reply[2], 16)))
-                    elif reply.startswith('+'):
-                        self.recv.put((QEmuTag.pin_high, int(reply[2], 16)))
-                    elif reply.startswith('='):
-                        slash = reply.rfind('/')
-                        value = int(reply[slash+1:], 16)
-                        if reply.startswith('=m'):
-                            addr = reply[:slash-1]
-                            if addr.endswith('3830'):
-                                self.recv.put((QEmuTag.gpiod_enabled, value))
-                            # elif addr.endswith('3840'):
-                            #     self.recv.put((QEmuTag.usart3_enabled, value))
-                            else:
-                                self.recv.put((QEmuTag.warning, f'Invalid memory address: {reply}'))
-                        elif reply.startswith('=d0'):
-                            self.recv.put((QEmuTag.moder, value))
-                        elif reply.startswith('=d4'):
-                            self.recv.put((QEmuTag.idr, value))
-                        elif reply.startswith('=u0'):
-                            self.recv.put((QEmuTag.sr, value))
-                        else:
-                            self.recv.put((QEmuTag.warning, f'Invalid response format: {reply}'))
-            except UserWarning as ex:
-                self.recv.put((QEmuTag.warning, str(ex)))
-            except OSError:
-                break  # raise UserWarning('Warning: QEMU connection closed')
+        responses = []
+        try:
+            async for replies in self.qemu.chunks():
+                parse_replies(replies, responses)
+                self.recv.extend(responses)
+                responses.clear()
+        except OSError:
+            self.recv.append((QEmuTag.warning, 'Warning: QEMU connection closed'))
+        except Exception as ex:
+            self.recv.append((QEmuTag.warning, f'Warning: QEMU listener failed: {ex!r}'))
+        finally:
+            self.qemu.closed = True     # discard any further commands
+            self.loop.stop()            # and let the background thread exit
 
 
 class WmsBoard:
@@ -246,12 +398,29 @@ class WmsBoard:
         self.latched = [False] * len(Config.buttons)
         self.sseg = 0
         self.motor = False
+        self.animating = False
         self.sprite = 0
         self.direction = 0
+        self.items = {}
+        self.led_info = []
+        self.ps_items = []
+        self.sseg_overlay = Config.overlays['sseg']
+        self.grid = self.build_grid()
 
     @staticmethod
-    def find_button(x: int, y: int):
+    def build_grid():
+        """ Maps each grid cell to the buttons whose bounding square overlaps it """
+        shift = Config.grid_shift
+        grid = {}
         for button in Config.buttons:
+            for cx in range((button.x - button.radius) >> shift, ((button.x + button.radius) >> shift) + 1):
+                for cy in range((button.y - button.radius) >> shift, ((button.y + button.radius) >> shift) + 1):
+                    grid[cx, cy] = grid.get((cx, cy), ()) + (button,)
+        return grid
+
+    def find_button(self, x: int, y: int):
+        shift = Config.grid_shift
+        for button in self.grid.get((x >> shift, y >> shift), ()):
             if button.x - button.radius <= x <= button.x + button.radius:
                 if button.y - button.radius <= y <= button.y + button.radius:
                     return button
@@ -259,62 +428,85 @@ class WmsBoard:
 
     @staticmethod
     def build_overlay(root):
+        images = {}     # share one PhotoImage between repeated file names
         with zipfile.ZipFile(Config.graphics_path) as archive:
             for tag, overlay in Config.overlays.items():
                 for i, name in enumerate(overlay.images):
-                    with archive.open(name) as file:
-                        overlay.images[i] = tk.PhotoImage(master=root, data=file.read())
+                    image = images.get(name)
+                    if image is None:
+                        with archive.open(name) as file:
+                            image = images[name] = tk.PhotoImage(master=root, data=file.read())
+                    overlay.images[i] = image
             with archive.open(Config.board_image) as file:
                 return tk.PhotoImage(master=root, data=file.read())
         # for tag, overlay in Config.overlays.items():
         #     for i, name in enumerate(overlay.images):
         #         overlay.images[i] = tk.PhotoImage(master=root, file=f'{folder}/{name}')
 
+    def create_items(self):
+        """
+        Creates one (initially blank) canvas image item per overlay
+        and per LED, updates then switch the item image in place
+        """
+        for tag, overlay in Config.overlays.items():
+            if tag != 'led':
+                self.items[tag] = self.canvas.create_image(overlay.x, overlay.y, anchor=tk.NW)
+        # per LED pin 8..11: (canvas item, sseg bit mask, images)
+        leds = Config.overlays['led']
+        self.led_info = [
+            (self.canvas.create_image(x, y, anchor=tk.NW), 1 << i, leds.images)
+            for i, (x, y) in enumerate(Config.led_xy)
+        ]
+        # PS key indicators reset when the latch is released: (canvas item, images)
+        self.ps_items = [(self.items[ps], Config.overlays[ps].images) for ps in ('PS1', 'PS2', 'PS3')]
+
     def update_device(self, pin: int, level: int, qemu: Diagnostics):
         if 8 <= pin <= 11:
-            overlay = Config.overlays['led']
-            x, y = Config.led_xy[pin - 8]
-            self.canvas.create_image(x, y, image=overlay.images[level], anchor=tk.NW)
+            item, mask, images = self.led_info[pin - 8]
+            self.canvas.itemconfigure(item, image=images[level])
             if level:
-                self.sseg |= 1 << (pin - 8)
+                self.sseg |= mask
             else:
-                self.sseg &= ~(1 << (pin - 8))
-            overlay = Config.overlays.get('sseg')
-            self.canvas.create_image(overlay.x, overlay.y, image=overlay.images[self.sseg], anchor=tk.NW)
+                self.sseg &= ~mask
+            self.canvas.itemconfigure(self.items['sseg'], image=self.sseg_overlay.images[self.sseg])
         elif pin == 12:
             overlay = Config.overlays['motor']
-            self.canvas.create_image(overlay.x, overlay.y, image=overlay.images[self.sprite], anchor=tk.NW)
-            # if not level:
-            #     overlay = Config.overlays['spinner']
-            #     self.canvas.create_image(overlay.x, overlay.y, image=overlay.images[0], anchor=tk.NW)
+            self.canvas.itemconfigure(self.items['motor'], image=overlay.images[self.sprite])
+            if not level:
+                # stopped motor hides the spinner (as the motor image did when drawn on top)
+                self.canvas.itemconfigure(self.items['spinner'], image='')
             self.motor = bool(level)
+            if self.motor and not self.animating:
+                self.animating = True
+                self.canvas.after(ANIMATE, self.animate)
         elif pin == 13:
             self.direction = level
         elif pin == 14:
             self.latch = bool(level)
             if not self.latch:
-                for button in Config.buttons:
-                    if not button.style == ButtonStyle.latch:
-                        continue
+                for button in Config.latch_buttons:
                     self.latched[button.pin] = False
                     if qemu:
                         qemu.command(button.up)
-                for ps in 'PS1', 'PS2', 'PS3':
-                    overlay = Config.overlays[ps]
-                    self.canvas.create_image(overlay.x, overlay.y, image=overlay.images[0], anchor=tk.NW)
+                for item, images in self.ps_items:
+                    self.canvas.itemconfigure(item, image=images[0])
 
     def animate(self):
-        if self.motor:
-            overlay = Config.overlays['motor']
-            self.canvas.create_image(overlay.x, overlay.y, image=overlay.images[self.sprite], anchor=tk.NW)
-            self.sprite = (self.sprite + 1) % len(overlay.images)
-            overlay = Config.overlays['spinner']
-            self.canvas.create_image(overlay.x, overlay.y, image=overlay.images[self.direction + 1], anchor=tk.NW)
+        """ Timer callback that only runs (and reschedules itself) while the motor is on """
+        if not self.motor:
+            self.animating = False
+            return
+        overlay = Config.overlays['motor']
+        self.canvas.itemconfigure(self.items['motor'], image=overlay.images[self.sprite])
+        self.sprite = (self.sprite + 1) % len(overlay.images)
+        overlay = Config.overlays['spinner']
+        self.canvas.itemconfigure(self.items['spinner'], image=overlay.images[self.direction + 1])
+        self.canvas.after(ANIMATE, self.animate)
 
     def update_button(self, button: Button, level: int):
-        overlay = Config.overlays.get(button.name)
-        if overlay:
-            self.canvas.create_image(overlay.x, overlay.y, image=overlay.images[level], anchor=tk.NW)
+        item = self.items.get(button.name)
+        if item:
+            self.canvas.itemconfigure(item, image=Config.overlays[button.name].images[level])
 
     def button_down(self, button: Button, qemu: Optional[Diagnostics]):
         if button.style == ButtonStyle.latch:
@@ -412,6 +604,10 @@ class WmsGui:
         self.qemu = None
         self.ticks = 0
         self.reattach = True
+        self.stamp_time = 0
+        self.stamp = ''
+        self.mode_value = None      # last displayed register values
+        self.idr_value = None
 
         self.style = ttk.Style()
         self.style.configure('.', sticky=(tk.N, tk.W), font=('Sans Serif', 10), padding=5)
@@ -434,6 +630,7 @@ class WmsGui:
         try:
             self.image = self.board.build_overlay(root)
             canvas.create_image(0, 0, image=self.image, anchor=tk.NW)
+            self.board.create_items()
 
         except Exception as ex:
             messagebox.showerror('Startup error', f'Error or missing graphics file:\n{ex}')
@@ -478,7 +675,11 @@ class WmsGui:
 
     def warning(self, value: str):
         if value:
-            self.warn_field['text'] = f'{datetime.now():%H:%M:%S} {value}'
+            now = int(time.time())
+            if now != self.stamp_time:      # only reformat once per second
+                self.stamp_time = now
+                self.stamp = time.strftime('%H:%M:%S', time.localtime(now))
+            self.warn_field['text'] = f'{self.stamp} {value}'
             self.ticks = POLL
         else:
             self.warn_field['text'] = ''
@@ -508,11 +709,8 @@ class WmsGui:
             self.qemu.write(QEmuTag.gpiod_enabled, Config.rcc_ahbenr)
         # if not self.usart3.get():
         #     self.qemu.write(QEmuTag.usart3_enabled, Config.rcc_apb1enr))
-        for _ in range(10):         # prevent GUI locking out
-            tag, value = self.qemu.read()
-            if tag is None:
-                break
-            elif tag == QEmuTag.warning:
+        for tag, value in self.qemu.drain(DRAIN_LIMIT):     # prevent GUI locking out
+            if tag == QEmuTag.warning:
                 self.warning(value)
                 continue
             if tag == QEmuTag.gpiod_enabled:
@@ -522,9 +720,17 @@ class WmsGui:
                     self.warning('Connected to QEMU')
                     self.reattach = True
             elif tag == QEmuTag.moder:
-                self.mode['text'] = f'mode: {value:08x}'
+                if value != self.mode_value:
+                    self.mode_value = value
+                    self.mode['text'] = f'mode: {value:08x}'
             elif tag == QEmuTag.idr:
-                self.idr['text'] = f'isr: {value:04x}'
+                changed = -1 if self.idr_value is None else value ^ self.idr_value
+                if changed:
+                    self.idr_value = value
+                    self.idr['text'] = f'isr: {value:04x}'
+                    for pin, check in enumerate(self.pins, 8):
+                        if (changed >> pin) & 1:
+                            check.set((value >> pin) & 1)
                 if self.reattach:
                     self.reattach = False
                     for pin in range(8, 15):
@@ -536,15 +742,12 @@ class WmsGui:
                         if (value >> button.pin) & 1:
                             self.board.button_down(button, None)
                             self.board.button_up(button, None)
-                for pin, check in enumerate(self.pins, 8):
-                    check.set((value >> pin) & 1)
             elif tag == QEmuTag.pin_low:
                 self.board.update_device(value, 0, self.qemu)
             elif tag == QEmuTag.pin_high:
                 self.board.update_device(value, 1, self.qemu)
         if self.gpiod.get():
-            self.qemu.write(QEmuTag.moder, b'D0? ')
-            self.qemu.write(QEmuTag.idr, b'D4? ')
+            self.qemu.command(b'D0? D4? ')
         # if self.usart3.get():
         #     self.qemu.write(QEmuTag.idr, b'U0? ')
 
@@ -569,7 +772,6 @@ class WmsGui:
                         self.on_close()
             else:
                 self.do_update_status()
-                self.board.animate()
         finally:
             self.root.after(POLL, self.on_timer)
 